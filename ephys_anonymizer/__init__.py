@@ -3,4 +3,8 @@
 __version__ = '0.1.5'
 
 
-from ephys_anonymizer.anonymizer import video_anonymize, raw_anonymize  # noqa
+from ephys_anonymizer.anonymizer import (video_anonymize, video_verify,  # noqa
+                                        video_find_seeds, raw_anonymize,
+                                        raw_anonymize_batch)
+from ephys_anonymizer.detectors import HaarDetector, DNNDetector  # noqa
+from ephys_anonymizer.session import session_anonymize  # noqa
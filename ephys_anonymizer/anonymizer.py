@@ -8,13 +8,28 @@ identiable information from an electrophysiology file.
 #
 # License: BSD (3-clause)
 
+import os
 import sys
+import glob
+import time
+import json
+import zlib
+import hashlib
+import threading
 import os.path as op
+from concurrent.futures import (ThreadPoolExecutor, ProcessPoolExecutor,
+                                as_completed)
 import numpy as np
 import cv2
 
+from ephys_anonymizer.detectors import CASCADES, HaarDetector, _get_detector
+
 MAX_BUFFER_S = 2
 TOLERANCE = 0.1
+BATCH_SIZE = 8
+TRACK_COLUMNS = ('frame', 'x', 'y', 'w', 'h', 'interpolated', 'transferred')
+CHUNK_SIZE = 2 ** 20
+VERIFY_SIZE = 320
 
 
 def _click_event(event, x, y, flags, param):
@@ -38,31 +53,419 @@ def _seed_face(frame_color):
     return click_x, click_y
 
 
-# based on https://opencv-python-tutroals.readthedocs.io/en/latest/py_tutorials
-# /py_objdetect/py_face_detection/py_face_detection.html
-def _find_face(frame_gray, cascades, seed, scale, neighbors, verbose=True):
-    """Find faces and cover with black."""
-    sx, sy = seed
-    # get the locations of the faces
-    for name, cascade in cascades.items():
-        faces = cascade.detectMultiScale(frame_gray, scale, neighbors)
-        for (x, y, w, h) in faces:
-            if abs(x + w / 2 - sx) / sx + abs(y + h / 2 - sy) / sy < TOLERANCE:
-                if 'eye' in name:
-                    return x - w * 3, y - h * 3, w * 6, h * 6
-                else:
-                    return x, y, w, h
+def _write_track(track, track_fname):
+    """Write the face box of each output frame to a tsv file."""
+    with open(track_fname, 'w') as fid:
+        fid.write('\t'.join(TRACK_COLUMNS) + '\n')
+        for i, box in enumerate(track):
+            fid.write('\t'.join(str(int(v)) for v in (i, *box)) + '\n')
+
+
+def _read_track(track_fname):
+    """Read a track tsv file written by :func:`video_anonymize`."""
+    with open(track_fname, 'r') as fid:
+        header = fid.readline().rstrip().split('\t')
+        if tuple(header) != TRACK_COLUMNS:
+            raise ValueError(f'Unrecognized track file header {header}, '
+                             f'expected {TRACK_COLUMNS}')
+        track = np.array([[int(v) for v in line.rstrip().split('\t')]
+                          for line in fid if line.strip()], dtype=int)
+    return track.reshape(-1, len(TRACK_COLUMNS))
+
+
+def _checksum(fname, stop=None, written=None):
+    """Get the SHA-256 and CRC-32 checksums of a file in one read.
+
+    Reading ends early, returning None, if the ``stop`` event is set. If
+    ``written`` is given, the file is followed as it is written, right
+    behind the writer, until the ``written`` event is set.
+    """
+    while written is not None and not op.isfile(fname):
+        if written.is_set():  # the file was never made
+            return None
+        time.sleep(0.01)
+    sha256 = hashlib.sha256()
+    crc32 = size = 0
+    with open(fname, 'rb') as fid:
+        while True:
+            finished = written is None or written.is_set()
+            chunk = fid.read(CHUNK_SIZE)
+            if stop is not None and stop.is_set():
+                return None
+            if chunk:
+                sha256.update(chunk)
+                crc32 = zlib.crc32(chunk, crc32)
+                size += len(chunk)
+            elif finished:
+                break
+            else:  # wait for the writer
+                time.sleep(0.01)
+    return dict(fname=op.abspath(fname), size=size,
+                sha256=sha256.hexdigest(), crc32=f'{crc32:08x}')
+
+
+class _BackgroundChecksum(object):
+    """Checksum a file on a thread, see :func:`_checksum`."""
+
+    def __init__(self, fname, follow=False):
+        self._stop = threading.Event()
+        self._written = threading.Event() if follow else None
+        pool = ThreadPoolExecutor(1)
+        self._future = pool.submit(_checksum, fname, stop=self._stop,
+                                   written=self._written)
+        pool.shutdown(wait=False)
+
+    def result(self):
+        """Wait for the checksum, once the file is written if followed."""
+        if self._written is not None:
+            self._written.set()
+        return self._future.result()
+
+    def cancel(self):
+        """Stop reading the file, e.g. if anonymizing it failed."""
+        self._stop.set()
+        if self._written is not None:
+            self._written.set()
+        self._future.result()
+
+
+def _save_raw(raw, out_fname, buffer_size_sec, overwrite, checksum=False):
+    """Save a raw file, hashing the bytes as they are written.
+
+    ``Raw.save`` only takes a file name and never goes back over what
+    it has written, so the output is hashed on a thread that reads it
+    right behind the writer while the bytes are still in memory. Any
+    split files after the first are not hashed.
+    """
+    output_checksum = None
+    if checksum:
+        if op.isfile(out_fname):  # so that only new bytes are hashed
+            os.remove(out_fname)
+        output_checksum = _BackgroundChecksum(out_fname, follow=True)
+    try:
+        raw.save(out_fname, buffer_size_sec=buffer_size_sec,
+                 overwrite=overwrite)
+    except BaseException:
+        if output_checksum is not None:
+            output_checksum.cancel()
+        raise
+    return None if output_checksum is None else output_checksum.result()
+
+
+def _write_manifest(manifest_fname, function, fname, out_fname,
+                    input_checksum, output_checksum, parameters, timings,
+                    verbose=True, **kwargs):
+    """Write a json audit manifest for an anonymized file.
+
+    Files without a checksum are listed with their size only.
+    """
+    from ephys_anonymizer import __version__
+    manifest = dict(
+        function=function, version=__version__,
+        date=time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        input=input_checksum or dict(fname=op.abspath(fname),
+                                     size=op.getsize(fname)),
+        output=output_checksum or dict(fname=op.abspath(out_fname),
+                                       size=op.getsize(out_fname)),
+        parameters=parameters, **kwargs, timings=timings)
+    with open(manifest_fname, 'w') as fid:
+        json.dump(manifest, fid, indent=4)
+    if verbose:
+        print('Manifest saved to {}'.format(manifest_fname))
+    return manifest
+
+
+def _interpolated_ranges(track):
+    """Get the first and last frame of each run of interpolated frames."""
+    ranges = list()
+    for i, (x, y, w, h, interpolated, transferred) in enumerate(track):
+        if interpolated:
+            if ranges and ranges[-1][1] == i - 1:
+                ranges[-1][1] = i
+            else:
+                ranges.append([i, i])
+    return ranges
+
+
+def _get_out_fname(fname, out_fname):
+    """Get the anonymized video file name."""
+    if out_fname is None:
+        return '{}-anon.mp4'.format(op.splitext(fname)[0])
+    return op.splitext(out_fname)[0] + '.mp4'
+
+
+def _open_video(fname, tmin):
+    """Open a video and read up to the first frame after ``tmin``."""
+    cap = cv2.VideoCapture(fname)
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+
+    ret, frame = cap.read()
+    i = 0
+    while ret and i < min([tmin, (frame_count - 2) / fps]):
+        ret, frame = cap.read()
+        i += 1 / fps
+
+    if op.splitext(fname)[-1] == '.mov':
+        frame_width = int(cap.get(4))
+        frame_height = int(cap.get(3))
+    else:
+        frame_width = int(cap.get(3))
+        frame_height = int(cap.get(4))
+    return cap, ret, frame, fps, frame_width, frame_height
+
+
+def _orient_frame(frame, ext):
+    """Rotate frames that are read sideways."""
+    if ext == '.mov':
+        frame = frame.swapaxes(0, 1)
+        frame = frame[:, ::-1]
+    return frame
+
+
+def _iter_detections(cap, ret, frame, ext, detector, min_size, max_size):
+    """Read the rest of the frames and find the faces in batches."""
+    while ret:
+        frames = list()
+        while ret and len(frames) < BATCH_SIZE:
+            frames.append(_orient_frame(frame, ext))
+            ret, frame = cap.read()
+        yield from zip(frames, detector.detect_batch(
+            frames, min_size=min_size, max_size=max_size))
+
+
+def _is_near(point, seed):
+    """Get whether a point is within the tolerance of the seed."""
+    (px, py), (sx, sy) = point, seed
+    return abs(px - sx) / sx + abs(py - sy) / sy < TOLERANCE
+
+
+def _find_face(boxes, seed):
+    """Find the first face near the seed."""
+    for (x, y, w, h) in boxes:
+        if _is_near((x + w / 2, y + h / 2), seed):
+            return x, y, w, h
     return None
 
 
+class _FaceTracker(object):
+    """Follow a face from a seed, covering it and interpolating misses."""
+
+    def __init__(self, seed, min_pixel_size, max_pixel_size, max_buffer_len,
+                 verbose=True):
+        self.seed = seed
+        self.min_pixel_size = min_pixel_size
+        self.max_pixel_size = max_pixel_size
+        self.max_buffer_len = max_buffer_len
+        self.verbose = verbose
+        self.frame_buffer = list()
+        self.track = list()
+
+    def find(self, boxes):
+        """Find the face near the seed if it is the right size."""
+        return self.check(_find_face(boxes, self.seed))
+
+    def check(self, face):
+        """Check that a face box is the right size."""
+        if face is None or min(face[2:]) < self.min_pixel_size or \
+                max(face[2:]) > self.max_pixel_size:
+            return None
+        return face
+
+    def update(self, frame, face, transferred=False):
+        """Cover the face in the next frame.
+
+        Frames without a face are held until the next face is found and
+        then covered by interpolation, so this returns the frames that
+        are ready to be written. Faces not found in this video but
+        transferred from another camera are marked in the track.
+        """
+        if face is None:
+            self.frame_buffer.append(frame)
+            if len(self.frame_buffer) > self.max_buffer_len:
+                raise ValueError(f'Video anonymization failure, there '
+                                 f'were more than {self.max_buffer_len} '
+                                 'frames without detecting a face, '
+                                 'report to developers')
+            return list()
+        x, y, w, h = face
+        frame[y: y + h, x:x + w] = 0
+        frames = list()
+        if len(self.frame_buffer) > 0:
+            n_interp = len(self.frame_buffer)
+            if self.verbose:
+                plural = 's' if n_interp > 1 else ''
+                sys.stdout.write(f'Interpolating {n_interp} frame{plural}')
+                sys.stdout.flush()
+            fx, fy = x + w / 2, y + h / 2
+            sx, sy = self.seed
+            xs = list(np.round(
+                np.linspace(sx, fx, n_interp) - w / 2).astype(int))
+            ys = list(np.round(
+                np.linspace(sy, fy, n_interp) - h / 2).astype(int))
+            while self.frame_buffer:
+                bframe, x, y = \
+                    self.frame_buffer.pop(0), xs.pop(0), ys.pop(0)
+                bframe[y: y + h, x:x + w] = 0
+                frames.append(bframe)
+                self.track.append((x, y, w, h, True, False))
+            self.seed = fx, fy
+        frames.append(frame)
+        self.track.append((*face, False, transferred))
+        return frames
+
+
+def _sample_frames(fname, tmin, duration, n_samples):
+    """Read frames evenly spaced over ``duration`` seconds from ``tmin``."""
+    ext = op.splitext(fname)[-1]
+    cap, ret, frame, fps, frame_width, frame_height = _open_video(fname, tmin)
+    step = max(int(duration * fps / n_samples), 1)
+    frames = list()
+    try:
+        while ret and len(frames) < n_samples:
+            frames.append(_orient_frame(frame, ext))
+            # skip the frames in between without decoding them fully
+            for _ in range(step):
+                ret = cap.grab()
+                if not ret:
+                    break
+            if ret:
+                ret, frame = cap.retrieve()
+    finally:
+        cap.release()
+    return frames, frame_width
+
+
+def _cluster_faces(detections):
+    """Link the faces found in each frame to the faces in earlier frames.
+
+    Each cluster follows a face over time, so the center of each face
+    found is compared to where the clusters were last seen. Boxes near
+    a face already found in the same frame, e.g. from the different Haar
+    cascades, are the same face.
+    """
+    clusters = list()
+    for i, (boxes, scores) in enumerate(detections):
+        matched = set()
+        for (x, y, w, h), score in zip(boxes, scores):
+            center = (x + w / 2, y + h / 2)
+            for j, cluster in enumerate(clusters):
+                if _is_near(center, cluster['last']):
+                    break
+            else:
+                j = len(clusters)
+                clusters.append(dict(first=center, frames=list(),
+                                     scores=list()))
+            if j in matched:  # another box of the same face
+                continue
+            cluster = clusters[j]
+            cluster['frames'].append(i)
+            cluster['scores'].append(score)
+            cluster['last'] = center
+            matched.add(j)
+    return clusters
+
+
+def video_find_seeds(fname, n_faces=1, tmin=0, duration=10, n_samples=30,
+                     scale=1.05, neighbors=1, min_size=0.03, max_size=0.1,
+                     detector='haar', min_confidence=0.5, verbose=True):
+    """Find where the faces are at the start of a video without clicking.
+
+    Frames are sampled from the start of the video and searched for
+    faces. The faces found are linked over time by their position and
+    of the faces in the first frame, where the face is followed from,
+    those found in the most frames are taken as the seeds, for use
+    as ``seed`` in :func:`video_anonymize` on computers without
+    a display.
+
+    Parameters
+    ----------
+    fname: str
+        The full file path of the video file.
+    n_faces: int
+        The number of faces to find, in order of how often they are found.
+    tmin: float
+        The time in seconds that the anonymized video will start.
+    duration: float
+        The time in seconds after ``tmin`` to sample frames from.
+    n_samples: int
+        The number of frames to sample.
+    scale: float
+        How finely to process the image, closer to 1 is more finely.
+        Only used for the "haar" detector.
+    neighbors: int
+        Number of close neighbors to require. Increase if too many
+        false positive faces in videos. Only used for the "haar" detector.
+    min_size: float
+        The minimum size of the box as a proportion of width.
+    max_size:
+        The maximum size of the box as a proportion of width.
+    detector: str | object
+        The face detector to use, see :func:`video_anonymize`.
+    min_confidence: float
+        The minimum proportion of the sampled frames that a face must be
+        found in to be used as a seed.
+    verbose: bool
+        Set verbose output to True or False.
+
+    Returns
+    -------
+    seeds: list of tuple
+        The ``(x, y)`` of the center of each face in the first frame,
+        at ``tmin``.
+    confidences: list of float
+        The proportion of the sampled frames that each face was found in.
+    """
+    if not 0 < min_confidence <= 1:
+        raise ValueError('`min_confidence` must be between 0 and 1, '
+                         f'got {min_confidence}')
+    detector = _get_detector(detector, scale, neighbors)
+    frames, frame_width = _sample_frames(fname, tmin, duration, n_samples)
+    if not frames:
+        raise ValueError(f'No frames were read from {fname} after {tmin} s')
+    min_pixel_size = np.round(frame_width * min_size).astype(int)
+    max_pixel_size = np.round(frame_width * max_size).astype(int)
+    detections = list()
+    for start in range(0, len(frames), BATCH_SIZE):
+        detections += detector.detect_batch(
+            frames[start: start + BATCH_SIZE],
+            min_size=(min_pixel_size,) * 2, max_size=(max_pixel_size,) * 2)
+    # the face must be found where it will be followed from
+    clusters = [cluster for cluster in _cluster_faces(detections)
+                if cluster['frames'][0] == 0]
+    # prefer faces found more often and then with higher scores
+    clusters.sort(key=lambda cluster: (len(cluster['frames']),
+                                       np.mean(cluster['scores'])),
+                  reverse=True)
+    seeds = [tuple(float(v) for v in cluster['first'])
+             for cluster in clusters[:n_faces]]
+    confidences = [len(cluster['frames']) / len(frames)
+                   for cluster in clusters[:n_faces]]
+    if len(seeds) < n_faces or min(confidences) < min_confidence:
+        found = ', '.join(f'{confidence:.2f}' for confidence in confidences)
+        raise ValueError(
+            f'Could not find {n_faces} face(s) in the first frame and in at '
+            f'least {min_confidence} of the {len(frames)} frames sampled '
+            f'from {fname}, the most often found were in {found or "none"} '
+            'of them; choose the seed by clicking or pass it as `seed` '
+            'instead')
+    if verbose:
+        for seed, confidence in zip(seeds, confidences):
+            print('Found a face at ({:.0f}, {:.0f}) in {:.0%} of the '
+                  'sampled frames'.format(*seed, confidence))
+    return seeds, confidences
+
+
 def video_anonymize(fname, out_fname=None, scale=1.05, neighbors=1, seed=None,
-                    tmin=0, min_size=0.03, max_size=0.1, overwrite=False,
-                    verbose=True):
+                    tmin=0, min_size=0.03, max_size=0.1, detector='haar',
+                    track_fname=None, manifest_fname=None,
+                    reread_checksums=False, overwrite=False, verbose=True):
     """Anonymize a video.
 
-    This function will use the Viola-Jones algorithm to detect faces
-    in a video and put a black box where the face is. The video is
-    saved as the file name with anon added in the same directory.
+    This function will use the Viola-Jones algorithm (or another face
+    detector, see ``detector``) to detect faces in a video and put
+    a black box where the face is. The video is saved as the file name
+    with anon added in the same directory.
 
     Parameters
     ----------
@@ -74,18 +477,40 @@ def video_anonymize(fname, out_fname=None, scale=1.05, neighbors=1, seed=None,
         Defaults to fname with '-anon.mp4' after.
     scale: float
         How finely to process the image, closer to 1 is more finely.
+        Only used for the "haar" detector.
     neighbors: int
         Number of close neighbors to require. Increase if too many
-        false positive faces in videos.
-    seed: tuple
+        false positive faces in videos. Only used for the "haar" detector.
+    seed: tuple | str
         Where to start finding the face. If None, the seed will be chosen by
-        clicking.
+        clicking. If "auto", the face found most often at the start of the
+        video is used, see :func:`video_find_seeds`, so that no display is
+        needed.
     tmin: float
         The time in seconds to start the anonymized video.
     min_size: float
         The minimum size of the box as a proportion of width.
     max_size:
         The maximum size of the box as a proportion of width.
+    detector: str | object
+        The face detector to use, "haar" for the Viola-Jones algorithm
+        (see :class:`HaarDetector`), "dnn" for a faster neural network
+        (see :class:`DNNDetector`) or a detector object with ``detect``
+        and ``detect_batch`` methods.
+    track_fname: str
+        If not None, a tsv file to save the face box of every frame of
+        the anonymized video to (and whether it was interpolated), for use
+        with :func:`video_verify`.
+    manifest_fname: str
+        If not None, a json file to save an audit manifest to with
+        the input and output files, the parameters, the number of frames,
+        the interpolated frames and the timings.
+    reread_checksums: bool
+        Whether to add the SHA-256 and CRC-32 checksums of the input and
+        output files to the manifest. The video writer seeks back in the
+        output so it cannot be hashed as it is written; instead the input
+        is read once more in the background and the output after it is
+        written. Defaults to False.
     overwrite: bool
         Whether to overwrite the existing file.
         Defaults to False.
@@ -97,41 +522,36 @@ def video_anonymize(fname, out_fname=None, scale=1.05, neighbors=1, seed=None,
     out_fname : str
         The name of the anonymized video file.
     """
-    basename, ext = op.splitext(fname)
-    if out_fname is None:
-        out_fname = '{}-anon.mp4'.format(basename)
-    else:
-        out_basename, out_ext = op.splitext(out_fname)
-        out_fname = out_basename + '.mp4'
+    ext = op.splitext(fname)[-1]
+    out_fname = _get_out_fname(fname, out_fname)
     if op.isfile(out_fname) and not overwrite:
         raise ValueError('Anonymized file exists, use '
                          '`overwrite=True` to overwrite')
+    if track_fname is not None and op.isfile(track_fname) and not overwrite:
+        raise ValueError('Track file exists, use '
+                         '`overwrite=True` to overwrite')
+    if manifest_fname is not None and op.isfile(manifest_fname) and \
+            not overwrite:
+        raise ValueError('Manifest file exists, use '
+                         '`overwrite=True` to overwrite')
+    start = time.time()
     if verbose:
         print('Reading in {}'.format(fname))
-    cascades = {name: cv2.CascadeClassifier('{}{}.xml'.format(
-        cv2.data.haarcascades, name)) for name in
-        ('haarcascade_frontalface_default',
-         'haarcascade_profileface',
-         'haarcascade_eye')}
-    cap = cv2.VideoCapture(fname)
-    fps = cap.get(cv2.CAP_PROP_FPS)
-    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-
-    ret, frame = cap.read()
-    i = 0
-    while ret and i < min([tmin, (frame_count - 2) / fps]):
-        ret, frame = cap.read()
-        i += 1 / fps
+    detector_name = detector if isinstance(detector, str) else \
+        type(detector).__name__
+    detector = _get_detector(detector, scale, neighbors)
+    seed_confidence = None
+    if isinstance(seed, str) and seed == 'auto':
+        (seed,), (seed_confidence,) = video_find_seeds(
+            fname, tmin=tmin, min_size=min_size, max_size=max_size,
+            detector=detector, verbose=verbose)
+    cap, ret, frame, fps, frame_width, frame_height = _open_video(fname, tmin)
 
     max_buffer_len = np.round(MAX_BUFFER_S * fps)
-    if ext == '.mov':
-        frame_width = int(cap.get(4))
-        frame_height = int(cap.get(3))
-    else:
-        frame_width = int(cap.get(3))
-        frame_height = int(cap.get(4))
     min_pixel_size = np.round(frame_width * min_size).astype(int)
     max_pixel_size = np.round(frame_width * max_size).astype(int)
+    min_box = (min_pixel_size, min_pixel_size)
+    max_box = (max_pixel_size, max_pixel_size)
 
     out = cv2.VideoWriter(out_fname, cv2.VideoWriter_fourcc(*'mp4v'),
                           fps, (frame_width, frame_height))
@@ -141,63 +561,302 @@ def video_anonymize(fname, out_fname=None, scale=1.05, neighbors=1, seed=None,
             print('Please click on the face to be anonymized to '
                   'seed the algorithm so that it gets the right one')
         seed = _seed_face(frame)
+    parameters = dict(scale=scale, neighbors=neighbors,
+                      seed=[float(v) for v in seed], tmin=tmin,
+                      min_size=min_size, max_size=max_size,
+                      detector=detector_name)
+    if seed_confidence is not None:
+        parameters['seed_confidence'] = seed_confidence
 
-    frame_buffer = list()
+    tracker = _FaceTracker(seed, min_pixel_size, max_pixel_size,
+                           max_buffer_len, verbose=verbose)
+    input_checksum = None
+    if manifest_fname is not None and reread_checksums:
+        input_checksum = _BackgroundChecksum(fname)
     if verbose:
         sys.stdout.write('Anonymizing .')
         sys.stdout.flush()
-    while ret:
-        if ext == '.mov':
-            frame = frame.swapaxes(0, 1)
-            frame = frame[:, ::-1]
-        frame_gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        face = _find_face(frame_gray, cascades, seed, scale,
-                          neighbors, verbose=verbose)
-        if face is None or min(face[2:]) < min_pixel_size or \
-                max(face[2:]) > max_pixel_size:
-            frame_buffer.append(frame)
-            if len(frame_buffer) > max_buffer_len:
-                cap.release()
-                out.release()
-                cv2.destroyAllWindows()
-                raise ValueError(f'Video anonymization failure, there '
-                                 f'were more than {max_buffer_len} frames '
-                                 'without detecting a face, '
-                                 'report to developers')
-        else:
-            x, y, w, h = face
-            frame[y: y + h, x:x + w] = 0
-            if len(frame_buffer) > 0:
-                n_interp = len(frame_buffer)
-                if verbose:
-                    plural = 's' if n_interp > 1 else ''
-                    sys.stdout.write(f'Interpolating {n_interp} frame{plural}')
-                    sys.stdout.flush()
-                fx, fy = x + w / 2, y + h / 2
-                sx, sy = seed
-                xs = list(np.round(
-                    np.linspace(sx, fx, n_interp) - w / 2).astype(int))
-                ys = list(np.round(
-                    np.linspace(sy, fy, n_interp) - h / 2).astype(int))
-                while frame_buffer:
-                    bframe, x, y = frame_buffer.pop(0), xs.pop(0), ys.pop(0)
-                    bframe[y: y + h, x:x + w] = 0
-                    out.write(bframe)
-                seed = fx, fy
-            out.write(frame)
-        ret, frame = cap.read()
-        if verbose:
-            sys.stdout.write('.')
-            sys.stdout.flush()
-    cap.release()
-    out.release()
-    cv2.destroyAllWindows()
+    try:
+        for frame, (boxes, scores) in _iter_detections(
+                cap, ret, frame, ext, detector, min_box, max_box):
+            for this_frame in tracker.update(frame, tracker.find(boxes)):
+                out.write(this_frame)
+            if verbose:
+                sys.stdout.write('.')
+                sys.stdout.flush()
+    except BaseException:
+        if input_checksum is not None:
+            input_checksum.cancel()
+        raise
+    finally:
+        cap.release()
+        out.release()
+        cv2.destroyAllWindows()
+    track = tracker.track
     if verbose:
         print('\nVideo saved to {}'.format(out_fname))
+    if track_fname is not None:
+        _write_track(track, track_fname)
+        if verbose:
+            print('Track saved to {}'.format(track_fname))
+    if manifest_fname is not None:
+        timings = dict(anonymize=time.time() - start)
+        output_checksum = None
+        if reread_checksums:
+            input_checksum = input_checksum.result()
+            start = time.time()
+            output_checksum = _checksum(out_fname)
+            timings['reread_checksums'] = time.time() - start
+        interpolated = _interpolated_ranges(track)
+        _write_manifest(
+            manifest_fname, 'video_anonymize', fname, out_fname,
+            input_checksum, output_checksum, parameters, timings,
+            verbose=verbose, anonymized=['faces'], n_frames=len(track),
+            n_interpolated=sum(last - first + 1
+                               for first, last in interpolated),
+            interpolated=interpolated)
     return out_fname
 
 
-def raw_anonymize(fname, out_fname=None, verbose=True, overwrite=False):
+def _n_verify_samples(n_frames, confidence, miss_rate):
+    """Get the number of frames to sample to bound the miss rate.
+
+    If none of ``n`` randomly sampled frames are missed, a miss rate of
+    ``miss_rate`` or more can be rejected with confidence
+    ``1 - (1 - miss_rate) ** n``.
+    """
+    if not 0 < confidence < 1:
+        raise ValueError(f'`confidence` must be between 0 and 1, '
+                         f'got {confidence}')
+    if not 0 < miss_rate < 1:
+        raise ValueError(f'`miss_rate` must be between 0 and 1, '
+                         f'got {miss_rate}')
+    n = int(np.ceil(np.log(1 - confidence) / np.log(1 - miss_rate)))
+    return min(n, n_frames)
+
+
+def _check_frame(frame, box, detector, threshold):
+    """Check that a face box is covered and that no face is found near it."""
+    x, y, w, h = box
+    # only check the inside of the box since compression blurs the edges
+    # and allow a few compression artifacts within it
+    inner = frame[max(y + h // 4, 0): max(y + h - h // 4, 0),
+                  max(x + w // 4, 0): max(x + w - w // 4, 0)]
+    if inner.size == 0 or np.percentile(inner, 90) > threshold:
+        return 'face box not covered'
+    # look for faces of about the same size in the neighborhood, padded
+    # and scaled to the same size in every frame for the detector
+    x0, y0, x1, y1 = x - 2 * w, y - 2 * h, x + 3 * w, y + 3 * h
+    crop = cv2.copyMakeBorder(
+        frame[max(y0, 0): max(y1, 0), max(x0, 0): max(x1, 0)],
+        max(-y0, 0), max(y1 - frame.shape[0], 0), max(-x0, 0),
+        max(x1 - frame.shape[1], 0), cv2.BORDER_CONSTANT, value=0)
+    crop = cv2.resize(crop, (VERIFY_SIZE, VERIFY_SIZE))
+    face_size = VERIFY_SIZE // 5
+    boxes, scores = detector.detect(
+        crop, min_size=(face_size // 2,) * 2, max_size=(face_size * 2,) * 2)
+    for fx, fy, fw, fh in boxes:
+        # a face near the box or sticking out of it is not covered
+        near = abs(fx + fw / 2 - VERIFY_SIZE / 2) < face_size and \
+            abs(fy + fh / 2 - VERIFY_SIZE / 2) < face_size
+        overlap = max(min(fx + fw, 3 * face_size) - max(fx, 2 * face_size),
+                      0) * \
+            max(min(fy + fh, 3 * face_size) - max(fy, 2 * face_size), 0)
+        if near or overlap > 0:
+            outside = 1 - overlap / (fw * fh)
+            return 'face found at {}, {} ({:.0%} outside the box)'.format(
+                int(round(x0 + fx * w / face_size)),
+                int(round(y0 + fy * h / face_size)), outside)
+    return None
+
+
+def video_verify(fname, track_fname, confidence=0.95, miss_rate=0.01,
+                 detector='dnn', scale=1.1, neighbors=3, threshold=7,
+                 random_state=None, verbose=True):
+    """Verify an anonymized video using a sample of its frames.
+
+    Instead of decoding every frame, this function uses the track saved
+    by :func:`video_anonymize` to check a stratified random sample of
+    frames as well as every interpolated frame and every frame where the
+    face was transferred from another camera by :func:`session_anonymize`.
+    For each frame checked,
+    the face box must be black and the face detector must not find
+    a face near the box or overlapping it.
+
+    Parameters
+    ----------
+    fname: str
+        The full file path of the anonymized video file.
+    track_fname: str
+        The track file saved by :func:`video_anonymize` using
+        ``track_fname``.
+    confidence: float
+        The confidence with which to reject a miss rate of ``miss_rate``
+        or more when no missed frames are found; this determines how
+        many frames are sampled.
+    miss_rate: float
+        The proportion of missed frames to test for.
+    detector: str | object
+        The face detector to use, "dnn" for a neural network
+        (see :class:`DNNDetector`), "haar" for the Viola-Jones algorithm
+        (see :class:`HaarDetector`), which misses more partly covered
+        faces, or a detector object with ``detect`` and ``detect_batch``
+        methods.
+    scale: float
+        How finely to process the image, closer to 1 is more finely.
+        Only used for the "haar" detector.
+    neighbors: int
+        Number of close neighbors to require. Only used for the "haar"
+        detector.
+    threshold: int
+        The maximum pixel value in a covered face box, greater than 0
+        because video compression is imprecise.
+    random_state: None | int | np.random.RandomState
+        The random state used to sample frames.
+    verbose: bool
+        Set verbose output to True or False.
+
+    Returns
+    -------
+    report : dict
+        The verification report with the number of frames in the video
+        (``n_frames``), sampled (``n_sampled``), interpolated
+        (``n_interpolated``), transferred from another camera
+        (``n_transferred``) and checked (``n_checked``), the failed
+        frames and reasons (``failures``), the ``confidence`` achieved
+        for ``miss_rate``, whether the video ``passed`` and the time
+        taken in seconds (``time``).
+    """
+    start = time.time()
+    track = _read_track(track_fname)
+    cap = cv2.VideoCapture(fname)
+    n_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    if n_frames == 0:
+        cap.release()
+        raise ValueError(f'No frames found in {fname}, nothing to verify')
+    if n_frames != len(track):
+        cap.release()
+        raise ValueError(f'The track has {len(track)} frames but the '
+                         f'video has {n_frames}, check that they match')
+    rng = random_state if isinstance(random_state, np.random.RandomState) \
+        else np.random.RandomState(random_state)
+    n_sampled = _n_verify_samples(n_frames, confidence, miss_rate)
+    # one frame from each of ``n_sampled`` evenly sized strata
+    edges = np.linspace(0, n_frames, n_sampled + 1).astype(int)
+    sampled = set(rng.randint(lo, hi) for lo, hi in
+                  zip(edges[:-1], edges[1:]) if hi > lo)
+    interpolated = set(np.where(track[:, 5])[0])
+    transferred = set(np.where(track[:, 6])[0])
+    checked = sampled | interpolated | transferred
+    if verbose:
+        print(f'Verifying {fname}: {len(sampled)} sampled, '
+              f'{len(interpolated)} interpolated and {len(transferred)} '
+              f'transferred of {n_frames} frames')
+    if detector == 'haar':  # eyes are covered so only look for faces
+        detector = HaarDetector(scale, neighbors, CASCADES[:2])
+    detector = _get_detector(detector)
+    failures = list()
+    pos = 0
+    for idx in sorted(checked):
+        if idx != pos:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, idx)
+        ret, frame = cap.read()
+        pos = idx + 1
+        if not ret:
+            failures.append((int(idx), 'frame could not be read'))
+            continue
+        reason = _check_frame(frame, track[idx, 1:5], detector, threshold)
+        if reason is not None:
+            failures.append((int(idx), reason))
+            if verbose:
+                print(f'Frame {idx} failed: {reason}')
+    cap.release()
+    if len(sampled) == n_frames:
+        achieved = 1.
+    else:
+        achieved = 1 - (1 - miss_rate) ** len(sampled)
+    report = dict(n_frames=n_frames, n_sampled=len(sampled),
+                  n_interpolated=len(interpolated),
+                  n_transferred=len(transferred), n_checked=len(checked),
+                  failures=failures, confidence=achieved,
+                  miss_rate=miss_rate, passed=len(failures) == 0,
+                  time=time.time() - start)
+    if verbose:
+        result = 'passed' if report['passed'] else \
+            'failed with {} frames missed'.format(len(failures))
+        print(f'Verification {result}, miss rate < {miss_rate} '
+              f'with confidence {achieved:.3f} '
+              f'({report["time"]:.1f} seconds)')
+    return report
+
+
+def _get_raw_out_fname(fname, out_fname):
+    """Get the anonymized raw file name."""
+    if out_fname is None:
+        return '{}-anon-raw.fif'.format(op.splitext(fname)[0])
+    out_basename, out_ext = op.splitext(out_fname)
+    if out_basename[-4:] in ('-raw', '_raw'):
+        return out_basename + '.fif'
+    return out_basename + '-raw.fif'
+
+
+def _get_memory(max_memory):
+    """Get a memory size in bytes from an int or a str like "2GB"."""
+    if isinstance(max_memory, str):
+        for unit, factor in (('GB', 1e9), ('MB', 1e6), ('kB', 1e3),
+                             ('B', 1)):
+            if max_memory.endswith(unit):
+                try:
+                    return int(float(max_memory[:-len(unit)]) * factor)
+                except ValueError:
+                    break
+        raise ValueError('`max_memory` must be a number of bytes or end '
+                         f'in "GB", "MB", "kB" or "B", got {max_memory}')
+    return int(max_memory)
+
+
+def _get_buffer_size_sec(raw, max_memory):
+    """Get the length of the chunks of data that fit in memory.
+
+    The memory only ever shortens the chunks of the original file,
+    longer chunks would not be faster and may not fit in one split file.
+    """
+    # data is read as double and written as single precision
+    n_bytes = raw.info['nchan'] * raw.info['sfreq'] * (8 + 4 + 4)
+    buffer_size_sec = max_memory / n_bytes
+    if buffer_size_sec * raw.info['sfreq'] < 1:
+        raise ValueError(f'`max_memory` of {max_memory} bytes is too small '
+                         f'to read one sample of {raw.filenames[0]}')
+    return min(raw.buffer_size_sec or 10, buffer_size_sec)
+
+
+def _readahead(fname, max_bytes):
+    """Ask the operating system to start reading a raw file into memory.
+
+    The files with the same name and other extensions are included
+    because some formats keep the data in a separate file. At most
+    ``max_bytes`` are read from the start of the files and the number
+    of bytes asked for is returned.
+    """
+    n_bytes = 0
+    for this_fname in glob.glob(glob.escape(op.splitext(fname)[0]) + '.*'):
+        this_n_bytes = min(op.getsize(this_fname), max_bytes - n_bytes)
+        if this_n_bytes <= 0:
+            break
+        if hasattr(os, 'posix_fadvise'):  # only on unix
+            fd = os.open(this_fname, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, this_n_bytes,
+                                 os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+        n_bytes += this_n_bytes
+    return n_bytes
+
+
+def raw_anonymize(fname, out_fname=None, verbose=True, overwrite=False,
+                  manifest_fname=None, max_memory=None,
+                  reread_checksums=False):
     """Anonymize a raw file.
 
     This function uses the mne-python anonymize functions to
@@ -215,6 +874,22 @@ def raw_anonymize(fname, out_fname=None, verbose=True, overwrite=False):
     overwrite : bool
         Whether to overwrite the existing file.
         Defaults to False.
+    manifest_fname : str
+        If not None, a json file to save an audit manifest to with
+        the input and output files, the names of the measurement info
+        fields that were anonymized, the number of time points and the
+        timings. The SHA-256 and CRC-32 checksums of the output are
+        computed as it is written.
+    max_memory : int | str | None
+        The memory budget for the chunks of data that are read and
+        written, as a number of bytes or a str like "500MB". The data is
+        read and written in the chunks of the original file, or in
+        shorter chunks (the ``buffer_size_sec`` of the output) if they
+        do not fit. If None, the chunks are not limited.
+    reread_checksums : bool
+        Whether to also add the checksums of the input file to the
+        manifest, which reads it once more in the background.
+        Defaults to False.
 
     Returns
     -------
@@ -222,18 +897,16 @@ def raw_anonymize(fname, out_fname=None, verbose=True, overwrite=False):
         The name of the anonymized video file.
     """
     import mne
-    basename, ext = op.splitext(fname)
-    if out_fname is None:
-        out_fname = '{}-anon-raw.fif'.format(basename)
-    else:
-        out_basename, out_ext = op.splitext(out_fname)
-        if out_basename[-4:] in ('-raw', '_raw'):
-            out_fname = out_basename + '.fif'
-        else:
-            out_fname = out_basename + '-raw.fif'
+    ext = op.splitext(fname)[-1]
+    out_fname = _get_raw_out_fname(fname, out_fname)
     if op.isfile(out_fname) and not overwrite:
         raise ValueError('Anonymized file exists, use '
                          '`overwrite=True` to overwrite')
+    if manifest_fname is not None and op.isfile(manifest_fname) and \
+            not overwrite:
+        raise ValueError('Manifest file exists, use '
+                         '`overwrite=True` to overwrite')
+    start = time.time()
     if verbose:
         print('Reading in {}'.format(fname))
     if ext == '.fif':
@@ -252,8 +925,144 @@ def raw_anonymize(fname, out_fname=None, verbose=True, overwrite=False):
                          '(eeglab)'.format(ext))
     if verbose:
         print('Anonymizing')
+    timings = dict(read=time.time() - start)
+    # only keep the original info to list the anonymized fields
+    info = None if manifest_fname is None else raw.info.copy()
     raw.anonymize()
     if verbose:
         print('Saving to {}'.format(out_fname))
-    raw.save(out_fname, overwrite=overwrite)
+    buffer_size_sec = None if max_memory is None else \
+        _get_buffer_size_sec(raw, _get_memory(max_memory))
+    input_checksum = None
+    if manifest_fname is not None and reread_checksums:
+        input_checksum = _BackgroundChecksum(fname)
+    start = time.time()
+    try:
+        output_checksum = _save_raw(raw, out_fname, buffer_size_sec,
+                                    overwrite,
+                                    checksum=manifest_fname is not None)
+    except BaseException:
+        if input_checksum is not None:
+            input_checksum.cancel()
+        raise
+    timings['save'] = time.time() - start
+    if manifest_fname is not None:
+        if input_checksum is not None:
+            start = time.time()
+            input_checksum = input_checksum.result()
+            timings['reread_checksums'] = time.time() - start
+        anonymized = [key for key in info if
+                      mne.utils.object_diff(info[key], raw.info[key])]
+        _write_manifest(manifest_fname, 'raw_anonymize', fname, out_fname,
+                        input_checksum, output_checksum, dict(), timings,
+                        verbose=verbose, anonymized=anonymized,
+                        n_times=int(raw.n_times))
     return out_fname
+
+
+def raw_anonymize_batch(fnames, out_fnames=None, n_jobs=None,
+                        max_memory='2GB', manifest_fnames=None,
+                        reread_checksums=False, overwrite=False,
+                        verbose=True):
+    """Anonymize many raw files in parallel.
+
+    The files are anonymized as in :func:`raw_anonymize` by a pool of
+    worker processes so that files are read while others are converted
+    and written. The operating system is asked to read the next files
+    into memory before a worker is free to start on them, as much of
+    them as fits in ``max_memory`` with the files being anonymized.
+
+    Parameters
+    ----------
+    fnames : list of str
+        The full file paths of the raw files.
+    out_fnames : list of str | None
+        The file names to save the anonymized raw files out to.
+        Defaults to each of fnames with '-anon-raw.fif' after.
+    n_jobs : int | None
+        The number of worker processes to use, defaults to the number
+        of CPUs.
+    max_memory : int | str
+        The memory budget across all the workers, as a number of bytes
+        or a str like "2GB". It bounds the chunks each worker writes its
+        file in (the ``buffer_size_sec`` of the output) to its share, and
+        the bytes of the input files read ahead at a time. It does not
+        bound the total memory of the workers, e.g. to read the file
+        header and measurement info.
+    manifest_fnames : list of str | None
+        If not None, a json file for each raw file to save an audit
+        manifest to, see :func:`raw_anonymize`.
+    reread_checksums : bool
+        Whether to also add the checksums of the input files to the
+        manifests, see :func:`raw_anonymize`.
+    overwrite : bool
+        Whether to overwrite the existing files.
+        Defaults to False.
+    verbose : bool
+        Set verbose output to True or False.
+
+    Returns
+    -------
+    out_fnames : list of str
+        The names of the anonymized raw files.
+    stats : dict
+        The ``n_bytes`` of the input files, the ``duration`` in seconds
+        and the ``throughput`` in MB/s.
+    """
+    n_files = len(fnames)
+    if out_fnames is None:
+        out_fnames = [None] * n_files
+    if manifest_fnames is None:
+        manifest_fnames = [None] * n_files
+    for name, param in dict(out_fnames=out_fnames,
+                            manifest_fnames=manifest_fnames).items():
+        if len(param) != n_files:
+            raise ValueError(f'Expected {n_files} {name}, one for each '
+                             f'file, got {len(param)}')
+    out_fnames = [_get_raw_out_fname(fname, out_fname)
+                  for fname, out_fname in zip(fnames, out_fnames)]
+    for this_fname in out_fnames + manifest_fnames:
+        if this_fname is not None and op.isfile(this_fname) and \
+                not overwrite:
+            raise ValueError(f'File {this_fname} exists, use '
+                             '`overwrite=True` to overwrite')
+    n_jobs = min(os.cpu_count() if n_jobs is None else n_jobs, n_files)
+    max_memory = _get_memory(max_memory)
+    worker_memory = max_memory // max(n_jobs, 1)
+    n_bytes = sum(op.getsize(this_fname) for fname in fnames for this_fname
+                  in glob.glob(glob.escape(op.splitext(fname)[0]) + '.*'))
+    if verbose:
+        print(f'Anonymizing {n_files} files with {n_jobs} workers')
+    start = time.time()
+    readahead = dict()  # the bytes read ahead of each file not yet done
+    next_idx = 0
+
+    def _readahead_next():
+        nonlocal next_idx
+        while next_idx < n_files and sum(readahead.values()) < max_memory:
+            readahead[next_idx] = _readahead(
+                fnames[next_idx], max_memory - sum(readahead.values()))
+            next_idx += 1
+
+    _readahead_next()
+    with ProcessPoolExecutor(max(n_jobs, 1)) as pool:
+        futures = {pool.submit(raw_anonymize, fname, out_fname,
+                               verbose=False, overwrite=overwrite,
+                               manifest_fname=manifest_fname,
+                               max_memory=worker_memory,
+                               reread_checksums=reread_checksums): i
+                   for i, (fname, out_fname, manifest_fname) in enumerate(
+                       zip(fnames, out_fnames, manifest_fnames))}
+        for future in as_completed(futures):
+            future.result()
+            readahead.pop(futures[future], None)
+            _readahead_next()
+            if verbose:
+                print('Saved {}'.format(out_fnames[futures[future]]))
+    duration = time.time() - start
+    stats = dict(n_bytes=n_bytes, duration=duration,
+                 throughput=n_bytes / 1e6 / duration)
+    if verbose:
+        print(f'Anonymized {n_bytes / 1e6:.1f} MB in {duration:.1f} seconds '
+              f'({stats["throughput"]:.1f} MB/s)')
+    return out_fnames, stats
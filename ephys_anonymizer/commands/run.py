@@ -2,6 +2,7 @@
 # Authors: Alex Rockhill <aprockhill@mailbox.org>
 #
 # License: BSD (3-clause)
+import sys
 import argparse
 
 import ephys_anonymizer
@@ -27,9 +28,13 @@ def video_anonymize():
                         help='How many neighboring pixels to use, '
                              'try scaling up or down if faces are not '
                              'being found')
-    parser.add_argument('--seed', default=None, nargs=2, type=int,
-                        help='Where the first face is in pixels, if not '
-                             'provided, a frame will be shown to click')
+    seed_group = parser.add_mutually_exclusive_group()
+    seed_group.add_argument('--seed', default=None, nargs=2, type=int,
+                            help='Where the first face is in pixels, if not '
+                                 'provided, a frame will be shown to click')
+    seed_group.add_argument('--auto_seed', action='store_true',
+                            help='Pass this flag to find the first face '
+                                 'without clicking, e.g. without a display')
     parser.add_argument('--tmin', default=0, type=float, required=False,
                         help='The time in seconds to start the anonymized '
                              'video')
@@ -39,6 +44,22 @@ def video_anonymize():
     parser.add_argument('--max_size', default=0.1, type=float, required=False,
                         help='The maximum size of the box as a'
                              'proportion of width.')
+    parser.add_argument('--detector', default='haar', type=str,
+                        choices=('haar', 'dnn'), required=False,
+                        help='The face detector to use, haar for the '
+                             'Viola-Jones algorithm or dnn for a faster '
+                             'neural network')
+    parser.add_argument('--track_fname', default=None, type=str,
+                        required=False,
+                        help='A tsv file to save the face box of every '
+                             'frame to, for use with video_verify')
+    parser.add_argument('--manifest_fname', default=None, type=str,
+                        required=False,
+                        help='A json file to save an audit manifest to')
+    parser.add_argument('--reread_checksums', action='store_true',
+                        help='Pass this flag to add checksums of the input '
+                             'and output to the manifest by reading them '
+                             'once more')
     parser.add_argument('--verbose', default=True, type=bool,
                         required=False,
                         help='Set verbose output to True or False.')
@@ -48,11 +69,64 @@ def video_anonymize():
     if args.out_fname is not None and len(args.out_fname) > 1:
         raise ValueError('Only one out_fname can be used as a positional '
                          f'argument, got {args.out_fname}')
+    seed = 'auto' if args.auto_seed else args.seed
     ephys_anonymizer.video_anonymize(
         args.filename, out_fname=args.out_fname, scale=args.scale,
-        neighbors=args.neighbors, seed=args.seed, tmin=args.tmin,
+        neighbors=args.neighbors, seed=seed, tmin=args.tmin,
         min_size=args.min_size, max_size=args.max_size,
-        overwrite=args.overwrite, verbose=args.verbose)
+        detector=args.detector, track_fname=args.track_fname,
+        manifest_fname=args.manifest_fname,
+        reread_checksums=args.reread_checksums, overwrite=args.overwrite,
+        verbose=args.verbose)
+
+
+def video_verify():
+    """Run video_verify command.
+
+    example usage:  $ video_verify fname track_fname --confidence 0.99
+                      --miss_rate 0.01 --verbose True
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('filename', type=str,
+                        help='Name of the anonymized video file to verify')
+    parser.add_argument('track_fname', type=str,
+                        help='Name of the track file saved by '
+                             'video_anonymize')
+    parser.add_argument('--confidence', default=0.95, type=float,
+                        required=False,
+                        help='The confidence with which to reject the '
+                             'miss rate, determines how many frames '
+                             'are sampled')
+    parser.add_argument('--miss_rate', default=0.01, type=float,
+                        required=False,
+                        help='The proportion of missed frames to test for')
+    parser.add_argument('--detector', default='dnn', type=str,
+                        choices=('haar', 'dnn'), required=False,
+                        help='The face detector to use, haar for the '
+                             'Viola-Jones algorithm or dnn for a faster '
+                             'neural network')
+    parser.add_argument('--scale', default=1.1, type=float, required=False,
+                        help='How fine of a resolution to use to parse '
+                             'the image')
+    parser.add_argument('--neighbors', default=3, type=int, required=False,
+                        help='How many neighboring pixels to use')
+    parser.add_argument('--threshold', default=7, type=int, required=False,
+                        help='The maximum pixel value in a covered face box')
+    parser.add_argument('--random_state', default=None, type=int,
+                        required=False,
+                        help='The random seed used to sample frames')
+    parser.add_argument('--verbose', default=True, type=bool,
+                        required=False,
+                        help='Set verbose output to True or False.')
+    args = parser.parse_args()
+    report = ephys_anonymizer.video_verify(
+        args.filename, args.track_fname, confidence=args.confidence,
+        miss_rate=args.miss_rate, detector=args.detector, scale=args.scale,
+        neighbors=args.neighbors,
+        threshold=args.threshold, random_state=args.random_state,
+        verbose=args.verbose)
+    if not report['passed']:
+        sys.exit(1)
 
 
 def raw_anonymize():
@@ -66,6 +140,13 @@ def raw_anonymize():
                         help='Name of the raw file to anonymize')
     parser.add_argument('out_fname', nargs='?', default=None, type=str,
                         help='Filename to save out to')
+    parser.add_argument('--manifest_fname', default=None, type=str,
+                        required=False,
+                        help='A json file to save an audit manifest with '
+                             'checksums of the output to')
+    parser.add_argument('--reread_checksums', action='store_true',
+                        help='Pass this flag to also add checksums of the '
+                             'input to the manifest by reading it once more')
     parser.add_argument('--verbose', default=True, type=bool,
                         required=False,
                         help='Set verbose output to True or False.')
@@ -77,4 +158,6 @@ def raw_anonymize():
                          f'argument, got {args.out_fname}')
     ephys_anonymizer.raw_anonymize(args.filename, out_fname=args.out_fname,
                                    overwrite=args.overwrite,
-                                   verbose=args.verbose)
+                                   verbose=args.verbose,
+                                   manifest_fname=args.manifest_fname,
+                                   reread_checksums=args.reread_checksums)
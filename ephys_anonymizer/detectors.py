@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""Face detectors for video anonymization.
+
+Each detector has a ``detect`` method that takes a color frame and
+returns the boxes of the faces found as ``(x, y, w, h)`` and a score
+for each box, in order of preference, and a ``detect_batch`` method
+that does the same for a list of frames.
+"""
+# Authors: Alex Rockhill <aprockhill@mailbox.org>
+#
+# License: BSD (3-clause)
+
+import os.path as op
+from collections import OrderedDict
+import numpy as np
+import cv2
+
+CASCADES = ('haarcascade_frontalface_default',
+            'haarcascade_profileface',
+            'haarcascade_eye')
+DNN_FNAME = op.join(op.dirname(__file__), 'data', 'centerface.onnx')
+DNN_OUTPUTS = ('537', '538', '539', '540')
+NMS_THRESHOLD = 0.3
+MAX_NETS = 3
+
+
+def _get_cascades(names=CASCADES):
+    """Load the Haar cascade classifiers that ship with OpenCV."""
+    return {name: cv2.CascadeClassifier('{}{}.xml'.format(
+        cv2.data.haarcascades, name)) for name in names}
+
+
+def _check_sizes(boxes, min_size, max_size):
+    """Get which boxes are within the minimum and maximum size."""
+    keep = np.ones(len(boxes), dtype=bool)
+    if min_size is not None:
+        keep &= (boxes[:, 2] >= min_size[0]) & (boxes[:, 3] >= min_size[1])
+    if max_size is not None:
+        keep &= (boxes[:, 2] <= max_size[0]) & (boxes[:, 3] <= max_size[1])
+    return keep
+
+
+# based on https://opencv-python-tutroals.readthedocs.io/en/latest/py_tutorials
+# /py_objdetect/py_face_detection/py_face_detection.html
+class HaarDetector(object):
+    """Detect faces with the Viola-Jones algorithm.
+
+    Faces are found using the Haar cascades that ship with OpenCV. Eyes
+    that are found are expanded to a box around the face.
+
+    Parameters
+    ----------
+    scale: float
+        How finely to process the image, closer to 1 is more finely.
+    neighbors: int
+        Number of close neighbors to require. Increase if too many
+        false positive faces in videos.
+    cascades: tuple
+        The names of the Haar cascades to use, in order of preference.
+    """
+
+    def __init__(self, scale=1.05, neighbors=1, cascades=CASCADES):
+        self.scale = scale
+        self.neighbors = neighbors
+        self._cascades = _get_cascades(cascades)
+
+    def detect(self, frame, min_size=None, max_size=None):
+        """Find the faces in a frame.
+
+        Parameters
+        ----------
+        frame: np.ndarray
+            The color frame to search.
+        min_size: tuple | None
+            The minimum ``(w, h)`` of the faces to find.
+        max_size: tuple | None
+            The maximum ``(w, h)`` of the faces to find.
+
+        Returns
+        -------
+        boxes: np.ndarray, shape (n_faces, 4)
+            The ``(x, y, w, h)`` of each face.
+        scores: np.ndarray, shape (n_faces,)
+            The number of neighbors that detected each face.
+        """
+        frame_gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        boxes, scores = list(), list()
+        for name, cascade in self._cascades.items():
+            faces, n_detections = cascade.detectMultiScale2(
+                frame_gray, self.scale, self.neighbors)
+            for (x, y, w, h), n in zip(faces, n_detections):
+                # eyes are expanded by six times to cover the face
+                if 'eye' in name:
+                    boxes.append((x - w * 3, y - h * 3, w * 6, h * 6))
+                else:
+                    boxes.append((x, y, w, h))
+                scores.append(n)
+        boxes = np.array(boxes, dtype=int).reshape(-1, 4)
+        scores = np.array(scores, dtype=float)
+        # the sizes are not passed to the cascades since that changes how
+        # the detections are grouped and so the boxes that are found
+        keep = _check_sizes(boxes, min_size, max_size)
+        return boxes[keep], scores[keep]
+
+    def detect_batch(self, frames, min_size=None, max_size=None):
+        """Find the faces in each of a list of frames.
+
+        See :meth:`detect` for details.
+        """
+        return [self.detect(frame, min_size, max_size) for frame in frames]
+
+
+class DNNDetector(object):
+    """Detect faces with a deep neural network on the CPU.
+
+    Faces are found with the CenterFace model bundled with this package
+    using the OpenCV ``dnn`` module, so no download or GPU is needed.
+    Frames are downsampled by ``input_scale`` and passed through the
+    network in batches for speed.
+
+    Parameters
+    ----------
+    input_scale: float
+        The proportion of the frame size to pass to the network.
+        Smaller is faster but misses smaller faces.
+    threshold: float
+        The minimum score of a face, between 0 and 1.
+    model_fname: str | None
+        The file path of a CenterFace onnx model. Defaults to the
+        bundled model.
+    """
+
+    def __init__(self, input_scale=0.5, threshold=0.5, model_fname=None):
+        self.input_scale = input_scale
+        self.threshold = threshold
+        self.model_fname = DNN_FNAME if model_fname is None else model_fname
+        self._nets = OrderedDict()
+
+    def _get_net(self, shape):
+        """Get a network for an input shape.
+
+        OpenCV does not reliably reallocate a network when the input shape
+        changes so a network is kept for each of the last few shapes,
+        e.g. for full batches and for the last batch of a video.
+        """
+        if shape in self._nets:
+            self._nets.move_to_end(shape)
+        else:
+            if len(self._nets) >= MAX_NETS:
+                self._nets.popitem(last=False)
+            self._nets[shape] = cv2.dnn.readNetFromONNX(self.model_fname)
+        return self._nets[shape]
+
+    def _input_size(self, frame):
+        """Get the network input size, which must be divisible by 32."""
+        height, width = frame.shape[:2]
+        return tuple(max(int(np.ceil(s * self.input_scale / 32) * 32), 32)
+                     for s in (width, height))
+
+    def _decode(self, heatmap, scale, offset, size_scale, min_size,
+                max_size):
+        """Get face boxes from the network output for one frame."""
+        rows, cols = np.where(heatmap[0] > self.threshold)
+        # the output maps are one quarter of the input size
+        hs = np.exp(scale[0, rows, cols]) * 4
+        ws = np.exp(scale[1, rows, cols]) * 4
+        ys = (rows + offset[0, rows, cols] + 0.5) * 4 - hs / 2
+        xs = (cols + offset[1, rows, cols] + 0.5) * 4 - ws / 2
+        scores = heatmap[0, rows, cols]
+        sx, sy = size_scale
+        boxes = np.array([xs / sx, ys / sy, ws / sx, hs / sy]).T
+        keep = _check_sizes(boxes, min_size, max_size)
+        boxes, scores = boxes[keep], scores[keep]
+        idx = cv2.dnn.NMSBoxes(boxes.tolist(), scores.tolist(),
+                               self.threshold, NMS_THRESHOLD)
+        idx = np.array(idx, dtype=int).ravel()
+        idx = idx[np.argsort(scores[idx])[::-1]]
+        return np.round(boxes[idx]).astype(int).reshape(-1, 4), \
+            scores[idx].astype(float)
+
+    def detect_batch(self, frames, min_size=None, max_size=None):
+        """Find the faces in each of a list of frames of the same size.
+
+        Parameters
+        ----------
+        frames: list of np.ndarray
+            The color frames to search.
+        min_size: tuple | None
+            The minimum ``(w, h)`` of the faces to find.
+        max_size: tuple | None
+            The maximum ``(w, h)`` of the faces to find.
+
+        Returns
+        -------
+        detections: list of tuple
+            The ``(x, y, w, h)`` boxes and scores of the faces in each
+            frame, ordered by score.
+        """
+        if len(frames) == 0:
+            return list()
+        size = self._input_size(frames[0])
+        size_scale = (size[0] / frames[0].shape[1],
+                      size[1] / frames[0].shape[0])
+        blob = cv2.dnn.blobFromImages(frames, 1.0, size, (0, 0, 0),
+                                      swapRB=True, crop=False)
+        net = self._get_net(blob.shape)
+        net.setInput(blob)
+        heatmaps, scales, offsets, _ = net.forward(list(DNN_OUTPUTS))
+        return [self._decode(heatmap, scale, offset, size_scale, min_size,
+                             max_size)
+                for heatmap, scale, offset in zip(heatmaps, scales, offsets)]
+
+    def detect(self, frame, min_size=None, max_size=None):
+        """Find the faces in a frame.
+
+        Parameters
+        ----------
+        frame: np.ndarray
+            The color frame to search.
+        min_size: tuple | None
+            The minimum ``(w, h)`` of the faces to find.
+        max_size: tuple | None
+            The maximum ``(w, h)`` of the faces to find.
+
+        Returns
+        -------
+        boxes: np.ndarray, shape (n_faces, 4)
+            The ``(x, y, w, h)`` of each face.
+        scores: np.ndarray, shape (n_faces,)
+            The score of each face, between 0 and 1.
+        """
+        return self.detect_batch([frame], min_size, max_size)[0]
+
+
+def _get_detector(detector, scale=1.05, neighbors=1):
+    """Get a face detector from its name."""
+    if detector == 'haar':
+        return HaarDetector(scale, neighbors)
+    elif detector == 'dnn':
+        return DNNDetector()
+    elif hasattr(detector, 'detect') and hasattr(detector, 'detect_batch'):
+        return detector
+    raise ValueError(f'`detector` must be "haar", "dnn" or an object with '
+                     f'`detect` and `detect_batch` methods, got {detector}')
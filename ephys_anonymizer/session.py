@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""Anonymize the videos of a session recorded by several cameras.
+
+The videos share a timeline so their frames are read, searched for faces
+and written in step, with the work for all the videos scheduled on one
+pool of workers.
+"""
+# Authors: Alex Rockhill <aprockhill@mailbox.org>
+#
+# License: BSD (3-clause)
+
+import os
+import sys
+import threading
+import os.path as op
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+
+from ephys_anonymizer.anonymizer import (
+    MAX_BUFFER_S, BATCH_SIZE, _FaceTracker, _get_out_fname, _open_video,
+    _orient_frame, _seed_face, _write_track, video_find_seeds)
+from ephys_anonymizer.detectors import _get_detector
+
+
+def _transform_point(point, transform):
+    """Apply a 3 x 3 projective transform to a point."""
+    x, y, z = np.dot(transform, (point[0], point[1], 1))
+    return x / z, y / z
+
+
+def _transform_box(box, transform, frame_width, frame_height):
+    """Get the box around the transformed corners of a box.
+
+    The box is clipped to the frame, None is returned if it is outside.
+    """
+    x, y, w, h = box
+    corners = np.array([_transform_point(corner, transform) for corner in
+                        ((x, y), (x + w, y), (x, y + h), (x + w, y + h))])
+    x0, y0 = np.maximum(np.floor(corners.min(axis=0)).astype(int), 0)
+    x1, y1 = np.minimum(np.ceil(corners.max(axis=0)).astype(int),
+                        (frame_width, frame_height))
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return x0, y0, x1 - x0, y1 - y0
+
+
+class _VideoJob(object):
+    """Read and write one of the videos of a session."""
+
+    def __init__(self, fname, tmin, min_size, max_size):
+        self.fname = fname
+        self.ext = op.splitext(fname)[-1]
+        self.cap, self.ret, self.frame, self.fps, self.frame_width, \
+            self.frame_height = _open_video(fname, tmin)
+        self.max_buffer_len = np.round(MAX_BUFFER_S * self.fps)
+        self.min_pixel_size = \
+            np.round(self.frame_width * min_size).astype(int)
+        self.max_pixel_size = \
+            np.round(self.frame_width * max_size).astype(int)
+        self.out = None
+        self.tracker = None
+
+    def start(self, out_fname, seed, verbose=True):
+        """Create the output file and follow the face from the seed."""
+        self.out = cv2.VideoWriter(
+            out_fname, cv2.VideoWriter_fourcc(*'mp4v'), self.fps,
+            (self.frame_width, self.frame_height))
+        self.tracker = _FaceTracker(
+            seed, self.min_pixel_size, self.max_pixel_size,
+            self.max_buffer_len, verbose=verbose)
+
+    def read(self, n_frames):
+        """Read the next frames."""
+        frames = list()
+        while self.ret and len(frames) < n_frames:
+            frames.append(_orient_frame(self.frame, self.ext))
+            self.ret, self.frame = self.cap.read()
+        return frames
+
+    def write(self, frames):
+        """Write frames that have been anonymized."""
+        for frame in frames:
+            self.out.write(frame)
+
+    def release(self):
+        """Close the video files."""
+        self.cap.release()
+        if self.out is not None:
+            self.out.release()
+
+
+def session_anonymize(fnames, out_fnames=None, seeds=None, tmin=0,
+                      transforms=None, scale=1.05, neighbors=1,
+                      min_size=0.03, max_size=0.1, detector='haar',
+                      track_fnames=None, n_jobs=None, overwrite=False,
+                      verbose=True):
+    """Anonymize the videos of one session recorded by several cameras.
+
+    The videos are processed together on a shared timeline: the frames
+    of each video are read, searched for faces and written by one pool
+    of workers, taking turns between the videos so that they all finish
+    together. The cameras are assumed to record at the same frame rate.
+    Otherwise, each video is anonymized as in :func:`video_anonymize`.
+
+    Parameters
+    ----------
+    fnames: list of str
+        The full file paths of the video files.
+    out_fnames: list of str | None
+        The file names to save the anonymized videos out to. Defaults to
+        each of fnames with '-anon.mp4' after.
+    seeds: list of tuple | str | None
+        Where to start finding the face in each video. If None or if the
+        seed of a video is None, the seed is chosen by clicking unless it
+        can be found from the seed of another camera using ``transforms``.
+        If "auto" or if the seed of a video is "auto", the seed is found
+        without clicking, see :func:`video_find_seeds`.
+    tmin: float | list of float
+        The time in seconds to start each anonymized video; use a list
+        to line up the videos on a common timeline.
+    transforms: list of np.ndarray | None
+        If the cameras are calibrated, a 3 x 3 projective transform for
+        each camera from its pixels to a common plane, e.g. the pixels
+        of the first camera. The face found by one camera is then used
+        for the other cameras when they miss it, if it is the right size
+        in their frames, and to find seeds. These faces are marked as
+        transferred in the tracks so that :func:`video_verify` checks them.
+    scale: float
+        How finely to process the image, closer to 1 is more finely.
+        Only used for the "haar" detector.
+    neighbors: int
+        Number of close neighbors to require. Increase if too many
+        false positive faces in videos. Only used for the "haar" detector.
+    min_size: float
+        The minimum size of the box as a proportion of width.
+    max_size:
+        The maximum size of the box as a proportion of width.
+    detector: str
+        The face detector to use, "haar" for the Viola-Jones algorithm
+        (see :class:`HaarDetector`) or "dnn" for a faster neural network
+        (see :class:`DNNDetector`). Each worker uses its own detector.
+    track_fnames: list of str | None
+        If not None, a tsv file for each video to save the face box of
+        every frame to, for use with :func:`video_verify`.
+    n_jobs: int | None
+        The number of workers to use, defaults to the number of CPUs.
+    overwrite: bool
+        Whether to overwrite the existing files.
+        Defaults to False.
+    verbose: bool
+        Set verbose output to True or False.
+
+    Returns
+    -------
+    out_fnames : list of str
+        The names of the anonymized video files.
+    """
+    n_videos = len(fnames)
+    if out_fnames is None:
+        out_fnames = [None] * n_videos
+    out_fnames = [_get_out_fname(fname, out_fname)
+                  for fname, out_fname in zip(fnames, out_fnames)]
+    seeds = [None] * n_videos if seeds is None else \
+        [seeds] * n_videos if isinstance(seeds, str) else list(seeds)
+    tmins = [tmin] * n_videos if np.isscalar(tmin) else list(tmin)
+    for name, param in dict(out_fnames=out_fnames, seeds=seeds,
+                            tmin=tmins, transforms=transforms,
+                            track_fnames=track_fnames).items():
+        if param is not None and len(param) != n_videos:
+            raise ValueError(f'Expected {n_videos} {name}, one for each '
+                             f'video, got {len(param)}')
+    if not isinstance(detector, str):
+        raise ValueError('`detector` must be "haar" or "dnn" so that each '
+                         f'worker can make its own, got {detector}')
+    for this_fname in out_fnames + (track_fnames or list()):
+        if op.isfile(this_fname) and not overwrite:
+            raise ValueError(f'File {this_fname} exists, use '
+                             '`overwrite=True` to overwrite')
+    if transforms is not None:
+        transforms = [np.array(transform, dtype=float)
+                      for transform in transforms]
+    if n_jobs is None:
+        n_jobs = os.cpu_count()
+    local = threading.local()
+
+    def detect(frames, min_size, max_size):
+        """Find faces using a detector for each worker."""
+        if not hasattr(local, 'detector'):
+            local.detector = _get_detector(detector, scale, neighbors)
+        return local.detector.detect_batch(frames, min_size, max_size)
+
+    for i, (fname, this_tmin) in enumerate(zip(fnames, tmins)):
+        if isinstance(seeds[i], str) and seeds[i] == 'auto':
+            (seeds[i],), _ = video_find_seeds(
+                fname, tmin=this_tmin, scale=scale, neighbors=neighbors,
+                min_size=min_size, max_size=max_size, detector=detector,
+                verbose=verbose)
+    if verbose:
+        print('Reading in {}'.format(', '.join(fnames)))
+    # the output files are only made once all the seeds are known
+    jobs = list()
+    pool = None
+    n_threads = cv2.getNumThreads()
+    try:
+        for fname, this_tmin in zip(fnames, tmins):
+            jobs.append(_VideoJob(fname, this_tmin, min_size, max_size))
+        for i, job in enumerate(jobs):
+            if seeds[i] is None and transforms is not None and \
+                    any(seed is not None for seed in seeds):
+                j = [seed is not None for seed in seeds].index(True)
+                seeds[i] = _transform_point(_transform_point(
+                    seeds[j], transforms[j]), np.linalg.inv(transforms[i]))
+            if seeds[i] is None:
+                if verbose:
+                    print('Please click on the face to be anonymized in '
+                          f'{job.fname} to seed the algorithm so that it '
+                          'gets the right one')
+                seeds[i] = _seed_face(job.frame)
+        for job, out_fname, seed in zip(jobs, out_fnames, seeds):
+            job.start(out_fname, seed, verbose=verbose)
+
+        # OpenCV's own threads would compete with the workers
+        cv2.setNumThreads(1)
+        pool = ThreadPoolExecutor(n_jobs)
+        if verbose:
+            sys.stdout.write('Anonymizing .')
+            sys.stdout.flush()
+        # read enough frames at a time to keep all the workers busy
+        n_frames = BATCH_SIZE * int(np.ceil(n_jobs / n_videos))
+        reads = [pool.submit(job.read, n_frames) for job in jobs]
+        writes = [None] * n_videos
+        while True:
+            frames = [read.result() for read in reads]
+            if not any(frames):
+                break
+            # take turns between the videos so that they progress together
+            detections = [list() for job in jobs]
+            for start in range(0, max(len(these) for these in frames),
+                               BATCH_SIZE):
+                for job, these, these_detections in zip(
+                        jobs, frames, detections):
+                    if start < len(these):
+                        these_detections.append(pool.submit(
+                            detect, these[start: start + BATCH_SIZE],
+                            (job.min_pixel_size,) * 2,
+                            (job.max_pixel_size,) * 2))
+            # read the next frames while these are searched and written
+            reads = [pool.submit(job.read, n_frames) for job in jobs]
+            detections = [[boxes for detection in these_detections
+                           for boxes, scores in detection.result()]
+                          for these_detections in detections]
+            ready = [list() for job in jobs]
+            for i in range(max(len(these) for these in frames)):
+                faces = [job.tracker.find(these[i]) if i < len(these)
+                         else None for job, these in zip(jobs, detections)]
+                transferred = [False] * n_videos
+                if transforms is not None:  # fill in misses from the others
+                    found = [j for j, face in enumerate(faces)
+                             if face is not None]
+                    for j, (job, face) in enumerate(zip(jobs, faces)):
+                        if face is None and found and i < len(frames[j]):
+                            faces[j] = job.tracker.check(_transform_box(
+                                faces[found[0]], np.dot(np.linalg.inv(
+                                    transforms[j]), transforms[found[0]]),
+                                job.frame_width, job.frame_height))
+                            transferred[j] = faces[j] is not None
+                for j, (job, face) in enumerate(zip(jobs, faces)):
+                    if i < len(frames[j]):
+                        ready[j] += job.tracker.update(
+                            frames[j][i], face, transferred[j])
+            for j, job in enumerate(jobs):
+                if writes[j] is not None:
+                    writes[j].result()
+                writes[j] = pool.submit(job.write, ready[j])
+            if verbose:
+                sys.stdout.write('.')
+                sys.stdout.flush()
+        for write in writes:
+            if write is not None:
+                write.result()
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=True)
+        cv2.setNumThreads(n_threads)
+        for job in jobs:
+            job.release()
+        cv2.destroyAllWindows()
+    if verbose:
+        print('\nVideos saved to {}'.format(', '.join(out_fnames)))
+    if track_fnames is not None:
+        for job, track_fname in zip(jobs, track_fnames):
+            _write_track(job.tracker.track, track_fname)
+        if verbose:
+            print('Tracks saved to {}'.format(', '.join(track_fnames)))
+    return out_fnames
@@ -8,6 +8,8 @@ For each supported file format, implement a test.
 # License: BSD (3-clause)
 
 import os.path as op
+import json
+import hashlib
 import mne
 from mne.datasets import testing
 
@@ -43,3 +45,74 @@ def test_raw_anonymize():
     ephys_anonymizer.raw_anonymize(edf_fname, out_fname, overwrite=True)
     raw = mne.io.read_raw_fif(out_fname)
     assert_array_almost_equal(raw.get_data(), raw.get_data(), decimal=10)
+
+
+@pytest.mark.filterwarnings('ignore::RuntimeWarning')
+def test_raw_anonymize_manifest():
+    out_dir = _TempDir()
+    out_fname = op.join(out_dir, 'test-anon-raw.fif')
+    manifest_fname = op.join(out_dir, 'test-manifest.json')
+    ephys_anonymizer.raw_anonymize(fif_fname, out_fname=out_fname,
+                                   manifest_fname=manifest_fname)
+    with open(manifest_fname, 'r') as fid:
+        manifest = json.load(fid)
+    # the output is hashed as it is written, the input only if asked
+    with open(out_fname, 'rb') as fid:
+        assert manifest['output']['sha256'] == \
+            hashlib.sha256(fid.read()).hexdigest()
+    assert 'sha256' not in manifest['input']
+    assert manifest['input']['size'] == op.getsize(fif_fname)
+    assert_array_almost_equal(mne.io.read_raw_fif(out_fname).get_data(),
+                              raw_fif.get_data(), decimal=10)
+    ephys_anonymizer.raw_anonymize(fif_fname, out_fname=out_fname,
+                                   manifest_fname=manifest_fname,
+                                   reread_checksums=True, overwrite=True)
+    with open(manifest_fname, 'r') as fid:
+        manifest = json.load(fid)
+    for key, fname in (('input', fif_fname), ('output', out_fname)):
+        with open(fname, 'rb') as fid:
+            assert manifest[key]['sha256'] == \
+                hashlib.sha256(fid.read()).hexdigest()
+    assert 'meas_date' in manifest['anonymized']
+    assert 'experimenter' in manifest['anonymized']
+    assert manifest['n_times'] == raw_fif.n_times
+    with pytest.raises(ValueError, match='Manifest file exists'):
+        ephys_anonymizer.raw_anonymize(fif_fname, out_fname=op.join(
+            out_dir, 'test2-anon-raw.fif'), manifest_fname=manifest_fname)
+
+
+@pytest.mark.filterwarnings('ignore::RuntimeWarning')
+def test_raw_anonymize_batch():
+    out_dir = _TempDir()
+    out_fnames = [op.join(out_dir, 'test-anon-raw.fif'),
+                  op.join(out_dir, 'test2-anon-raw.fif')]
+    out_fnames2, stats = ephys_anonymizer.raw_anonymize_batch(
+        [fif_fname, edf_fname], out_fnames, n_jobs=2, max_memory='100MB',
+        verbose=False)
+    assert out_fnames2 == out_fnames
+    assert stats['n_bytes'] >= op.getsize(fif_fname) + op.getsize(edf_fname)
+    assert stats['throughput'] == \
+        pytest.approx(stats['n_bytes'] / 1e6 / stats['duration'])
+    for out_fname, raw_orig in zip(out_fnames, (raw_fif, raw_edf)):
+        raw = mne.io.read_raw_fif(out_fname)
+        assert raw.info['experimenter'] == 'mne_anonymize'
+        assert_array_almost_equal(raw.get_data(), raw_orig.get_data(),
+                                  decimal=10)
+        # the memory only ever shortens the chunks of the original file
+        assert raw.buffer_size_sec <= \
+            raw_orig.buffer_size_sec + 1 / raw.info['sfreq']
+    # a small memory shortens the chunks to fit
+    ephys_anonymizer.raw_anonymize(fif_fname, out_fnames[0],
+                                   max_memory='100kB', overwrite=True)
+    raw = mne.io.read_raw_fif(out_fnames[0])
+    n_bytes = raw.info['nchan'] * raw.info['sfreq'] * 16
+    assert raw.buffer_size_sec < raw_fif.buffer_size_sec
+    assert raw.buffer_size_sec <= 1e5 / n_bytes + 1 / raw.info['sfreq']
+    with pytest.raises(ValueError, match='exists'):
+        ephys_anonymizer.raw_anonymize_batch([fif_fname], out_fnames[:1])
+    with pytest.raises(ValueError, match='too small'):
+        ephys_anonymizer.raw_anonymize_batch(
+            [fif_fname], out_fnames[:1], max_memory='10B', overwrite=True)
+    with pytest.raises(ValueError, match='must be a number of bytes'):
+        ephys_anonymizer.raw_anonymize_batch(
+            [fif_fname], out_fnames[:1], max_memory='1TB', overwrite=True)
@@ -8,7 +8,13 @@ For each supported file format, implement a test.
 # License: BSD (3-clause)
 
 import os.path as op
+import json
+import zlib
+import hashlib
 import cv2
+import numpy as np
+import pytest
+from numpy.testing import assert_array_equal, assert_allclose
 from mne.utils import _TempDir
 
 import ephys_anonymizer
@@ -48,3 +54,287 @@ def test_video_anonymize():
             i += 1
         cap.release()
     cv2.destroyAllWindows()
+
+
+def test_video_verify():
+    out_dir = _TempDir()
+    fname = op.join(basepath, 'test_vid.mp4')
+    out_fname = op.join(out_dir, 'test_vid-anon.mp4')
+    track_fname = op.join(out_dir, 'test_vid-track.tsv')
+    ephys_anonymizer.video_anonymize(
+        fname, out_fname=out_fname, seed=seed, track_fname=track_fname)
+    report = ephys_anonymizer.video_verify(
+        out_fname, track_fname, confidence=0.5, miss_rate=0.1,
+        random_state=0)
+    assert report['passed']
+    assert report['n_sampled'] < report['n_frames']
+    assert report['confidence'] >= 0.5
+    report = ephys_anonymizer.video_verify(out_fname, track_fname)
+    assert report['passed']
+    assert report['n_checked'] == report['n_frames']
+    assert report['confidence'] == 1
+
+    # the same frames without anonymization should fail
+    cap = cv2.VideoCapture(fname)
+    bad_fname = op.join(out_dir, 'test_vid-bad.mp4')
+    out = cv2.VideoWriter(bad_fname, cv2.VideoWriter_fourcc(*'mp4v'),
+                          cap.get(cv2.CAP_PROP_FPS),
+                          (int(cap.get(3)), int(cap.get(4))))
+    for _ in range(report['n_frames']):
+        ret, frame = cap.read()
+        out.write(frame)
+    cap.release()
+    out.release()
+    report = ephys_anonymizer.video_verify(
+        bad_fname, track_fname, confidence=0.5, miss_rate=0.1,
+        random_state=0)
+    assert not report['passed']
+    assert len(report['failures']) == report['n_checked']
+
+    # a black box that only covers half of the face should be found
+    # by the face detector
+    track = np.loadtxt(track_fname, skiprows=1, dtype=int)
+    track[:, 1] += track[:, 3] // 2
+    cap = cv2.VideoCapture(fname)
+    shift_fname = op.join(out_dir, 'test_vid-shift.mp4')
+    shift_track_fname = op.join(out_dir, 'test_vid-shift-track.tsv')
+    out = cv2.VideoWriter(shift_fname, cv2.VideoWriter_fourcc(*'mp4v'),
+                          cap.get(cv2.CAP_PROP_FPS),
+                          (int(cap.get(3)), int(cap.get(4))))
+    for i, x, y, w, h, interpolated, transferred in track:
+        ret, frame = cap.read()
+        frame[y: y + h, x: x + w] = 0
+        out.write(frame)
+    cap.release()
+    out.release()
+    with open(shift_track_fname, 'w') as fid:
+        fid.write('frame\tx\ty\tw\th\tinterpolated\ttransferred\n')
+        for row in track:
+            fid.write('\t'.join(str(v) for v in row) + '\n')
+    report = ephys_anonymizer.video_verify(
+        shift_fname, shift_track_fname, confidence=0.5, miss_rate=0.1,
+        random_state=0)
+    assert not report['passed']
+    assert all('face found' in reason for idx, reason in report['failures'])
+
+    with pytest.raises(ValueError, match='must be between 0 and 1'):
+        ephys_anonymizer.video_verify(out_fname, track_fname, confidence=1)
+    with pytest.raises(ValueError, match='frames but the video has'):
+        ephys_anonymizer.video_verify(fname, track_fname)
+
+
+def test_detectors():
+    cap = cv2.VideoCapture(op.join(basepath, 'test_vid.mp4'))
+    frames = [cap.read()[1] for _ in range(3)]
+    cap.release()
+    for detector in (ephys_anonymizer.HaarDetector(),
+                     ephys_anonymizer.DNNDetector()):
+        detections = detector.detect_batch(frames)
+        assert len(detections) == len(frames)
+        for (boxes, scores), x, y in zip(detections, face_data['x'],
+                                         face_data['y']):
+            assert boxes.shape == (scores.size, 4)
+            assert any(bx <= x <= bx + w and by <= y <= by + h
+                       for bx, by, w, h in boxes)
+        boxes, scores = detector.detect(frames[0], min_size=(20, 20),
+                                        max_size=(60, 60))
+        assert boxes.size > 0
+        assert (boxes[:, 2:] >= 20).all() and (boxes[:, 2:] <= 60).all()
+
+    # batches of different sizes must give the same detections
+    detector = ephys_anonymizer.DNNDetector()
+    boxes, scores = detector.detect(frames[0])
+    detector.detect_batch(frames)
+    boxes2, scores2 = detector.detect(frames[0])
+    assert_array_equal(boxes, boxes2)
+    # only the networks for the last few input shapes are kept
+    for size in (64, 96, 128, 160):
+        detector.detect(cv2.resize(frames[0], (size, size)))
+    assert len(detector._nets) <= 3
+    boxes2, scores2 = detector.detect(frames[0])
+    assert_array_equal(boxes, boxes2)
+
+    out_dir = _TempDir()
+    out_fname = op.join(out_dir, 'test_vid-anon.mp4')
+    track_fname = op.join(out_dir, 'test_vid-track.tsv')
+    ephys_anonymizer.video_anonymize(
+        op.join(basepath, 'test_vid.mp4'), out_fname=out_fname, seed=seed,
+        max_size=0.15, detector='dnn', track_fname=track_fname)
+    report = ephys_anonymizer.video_verify(out_fname, track_fname)
+    assert report['passed']
+
+    with pytest.raises(ValueError, match='`detector` must be'):
+        ephys_anonymizer.video_anonymize(
+            op.join(basepath, 'test_vid.mp4'), out_fname=out_fname,
+            seed=seed, detector='foo', overwrite=True)
+
+
+def test_video_anonymize_manifest():
+    out_dir = _TempDir()
+    fname = op.join(basepath, 'test_vid.mp4')
+    out_fname = op.join(out_dir, 'test_vid-anon.mp4')
+    track_fname = op.join(out_dir, 'test_vid-track.tsv')
+    manifest_fname = op.join(out_dir, 'test_vid-manifest.json')
+    ephys_anonymizer.video_anonymize(
+        fname, out_fname=out_fname, seed=seed, max_size=0.15,
+        detector='dnn', track_fname=track_fname,
+        manifest_fname=manifest_fname)
+    with open(manifest_fname, 'r') as fid:
+        manifest = json.load(fid)
+    # the files are only read again for their checksums if asked
+    assert 'sha256' not in manifest['input']
+    assert manifest['output']['size'] == op.getsize(out_fname)
+    ephys_anonymizer.video_anonymize(
+        fname, out_fname=out_fname, seed=seed, max_size=0.15,
+        detector='dnn', track_fname=track_fname,
+        manifest_fname=manifest_fname, reread_checksums=True,
+        overwrite=True)
+    with open(manifest_fname, 'r') as fid:
+        manifest = json.load(fid)
+    for key, this_fname in (('input', fname), ('output', out_fname)):
+        with open(this_fname, 'rb') as fid:
+            data = fid.read()
+        assert manifest[key]['sha256'] == hashlib.sha256(data).hexdigest()
+        assert int(manifest[key]['crc32'], 16) == zlib.crc32(data)
+    with open(track_fname, 'r') as fid:
+        n_frames = len(fid.readlines()) - 1
+    assert manifest['n_frames'] == n_frames
+    assert manifest['parameters']['detector'] == 'dnn'
+    assert manifest['parameters']['seed'] == list(seed)
+
+
+def test_video_find_seeds():
+    out_dir = _TempDir()
+    fname = op.join(basepath, 'test_vid.mp4')
+    seeds, confidences = ephys_anonymizer.video_find_seeds(
+        fname, max_size=0.15, detector='dnn')
+    assert len(seeds) == len(confidences) == 1
+    assert_allclose(seeds[0], seed, atol=5)
+    assert confidences[0] > 0.9
+    with pytest.raises(ValueError, match='Could not find 2 face'):
+        ephys_anonymizer.video_find_seeds(
+            fname, n_faces=2, max_size=0.15, detector='dnn')
+    with pytest.raises(ValueError, match='between 0 and 1'):
+        ephys_anonymizer.video_find_seeds(fname, min_confidence=2)
+
+    # two boxes on the same face, e.g. from two Haar cascades, are one face
+    class DuplicateDetector(object):
+        def detect(self, frame, min_size=None, max_size=None):
+            return np.array([[100, 100, 40, 40], [102, 101, 40, 40]]), \
+                np.ones(2)
+
+        def detect_batch(self, frames, min_size=None, max_size=None):
+            return [self.detect(frame) for frame in frames]
+
+    seeds2, confidences2 = ephys_anonymizer.video_find_seeds(
+        fname, detector=DuplicateDetector())
+    assert seeds2 == [(120, 120)] and confidences2 == [1]
+    with pytest.raises(ValueError, match='Could not find 2 face'):
+        ephys_anonymizer.video_find_seeds(
+            fname, n_faces=2, detector=DuplicateDetector())
+
+    # a face only found after the first frame can't be followed from there
+    class LateDetector(DuplicateDetector):
+        def __init__(self):
+            self.n_frames = 0
+
+        def detect(self, frame, min_size=None, max_size=None):
+            self.n_frames += 1
+            if self.n_frames == 1:
+                return np.zeros((0, 4), dtype=int), np.zeros(0)
+            return np.array([[100, 100, 40, 40]]), np.ones(1)
+
+    with pytest.raises(ValueError, match='in the first frame'):
+        ephys_anonymizer.video_find_seeds(fname, detector=LateDetector())
+
+    # no face to find
+    cap = cv2.VideoCapture(fname)
+    width, height = int(cap.get(3)), int(cap.get(4))
+    cap.release()
+    black_fname = op.join(out_dir, 'black.mp4')
+    out = cv2.VideoWriter(black_fname, cv2.VideoWriter_fourcc(*'mp4v'),
+                          30, (width, height))
+    for _ in range(30):
+        out.write(np.zeros((height, width, 3), dtype=np.uint8))
+    out.release()
+    with pytest.raises(ValueError, match='most often found were in none'):
+        ephys_anonymizer.video_find_seeds(black_fname, detector='dnn')
+
+    # anonymize without clicking
+    out_fname = op.join(out_dir, 'test_vid-anon.mp4')
+    track_fname = op.join(out_dir, 'test_vid-track.tsv')
+    manifest_fname = op.join(out_dir, 'test_vid-manifest.json')
+    ephys_anonymizer.video_anonymize(
+        fname, out_fname=out_fname, seed='auto', max_size=0.15,
+        detector='dnn', track_fname=track_fname,
+        manifest_fname=manifest_fname)
+    assert ephys_anonymizer.video_verify(out_fname, track_fname)['passed']
+    with open(manifest_fname, 'r') as fid:
+        manifest = json.load(fid)
+    assert_allclose(manifest['parameters']['seed'], seeds[0])
+    assert manifest['parameters']['seed_confidence'] == confidences[0]
+
+
+def test_session_anonymize():
+    out_dir = _TempDir()
+    fname = op.join(basepath, 'test_vid.mp4')
+    # make a second camera that sees the mirror image
+    cap = cv2.VideoCapture(fname)
+    width, height = int(cap.get(3)), int(cap.get(4))
+    flip_fname = op.join(out_dir, 'test_vid_flip.mp4')
+    out = cv2.VideoWriter(flip_fname, cv2.VideoWriter_fourcc(*'mp4v'),
+                          cap.get(cv2.CAP_PROP_FPS), (width, height))
+    ret, frame = cap.read()
+    while ret:
+        out.write(frame[:, ::-1].copy())
+        ret, frame = cap.read()
+    cap.release()
+    out.release()
+    flip = np.array([[-1, 0, width], [0, 1, 0], [0, 0, 1]])
+    out_fnames = [op.join(out_dir, 'test_vid-anon.mp4'),
+                  op.join(out_dir, 'test_vid_flip-anon.mp4')]
+    track_fnames = [op.join(out_dir, 'test_vid-track.tsv'),
+                    op.join(out_dir, 'test_vid_flip-track.tsv')]
+    assert ephys_anonymizer.session_anonymize(
+        [fname, flip_fname], out_fnames, seeds=[seed, None],
+        transforms=[np.eye(3), flip], max_size=0.15, detector='dnn',
+        track_fnames=track_fnames, n_jobs=2) == out_fnames
+    tracks = list()
+    for out_fname, track_fname in zip(out_fnames, track_fnames):
+        track = np.loadtxt(track_fname, skiprows=1, dtype=int)
+        report = ephys_anonymizer.video_verify(out_fname, track_fname)
+        assert report['passed']
+        # the faces from the other camera are all checked
+        assert report['n_transferred'] == track[:, 6].sum()
+        tracks.append(track)
+    # the mirrored face is covered in the same place
+    n_frames = min(len(track) for track in tracks)
+    assert n_frames > 0
+    assert_allclose(tracks[0][:n_frames, 1] + tracks[0][:n_frames, 3],
+                    width - tracks[1][:n_frames, 1], atol=5)
+
+    # faces from the other camera are not used outside of the frame
+    shift = np.dot([[1, 0, 3 * width], [0, 1, 0], [0, 0, 1]], flip)
+    ephys_anonymizer.session_anonymize(
+        [fname, flip_fname], out_fnames, seeds=[seed, (width - seed[0],
+                                                       seed[1])],
+        transforms=[np.eye(3), shift], max_size=0.15, detector='dnn',
+        track_fnames=track_fnames, n_jobs=2, overwrite=True)
+    for track_fname in track_fnames:
+        track = np.loadtxt(track_fname, skiprows=1, dtype=int)
+        assert not track[:, 6].any()
+
+    # no output files are left behind if the seeds cannot be found
+    bad_fnames = [op.join(out_dir, 'test_vid-bad.mp4'),
+                  op.join(out_dir, 'test_vid_flip-bad.mp4')]
+    with pytest.raises(np.linalg.LinAlgError):
+        ephys_anonymizer.session_anonymize(
+            [fname, flip_fname], bad_fnames, seeds=[seed, None],
+            transforms=[np.eye(3), np.zeros((3, 3))])
+    assert not any(op.isfile(bad_fname) for bad_fname in bad_fnames)
+    with pytest.raises(ValueError, match='Expected 2 seeds'):
+        ephys_anonymizer.session_anonymize(
+            [fname, flip_fname], out_fnames, seeds=[seed])
+    with pytest.raises(ValueError, match='exists'):
+        ephys_anonymizer.session_anonymize(
+            [fname, flip_fname], out_fnames, seeds=[seed, seed])
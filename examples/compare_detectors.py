@@ -0,0 +1,76 @@
+"""
+==========================
+02. Compare Face Detectors
+==========================
+
+In this example, we compare the speed and the miss rate of the face
+detectors that can be used by :func:`ephys_anonymizer.video_anonymize`
+on the test videos.
+
+.. currentmodule:: ephys_anonymizer
+
+"""
+
+# Authors: Alex Rockhill <aprockhill@mailbox.org>
+#
+# License: BSD (3-clause)
+
+###############################################################################
+# We are importing everything we need for this example:
+import os
+import time
+
+import cv2
+import ephys_anonymizer
+
+from ephys_anonymizer import HaarDetector, DNNDetector
+
+###############################################################################
+# Load the face locations
+# -----------------------
+#
+# The location of the face was marked by hand in each frame of the
+# test videos.
+
+data_path = os.path.join(os.path.dirname(ephys_anonymizer.__file__),
+                         'tests', 'data')
+with open(os.path.join(data_path, 'face_data.tsv'), 'r') as fid:
+    fid.readline()  # header
+    face_data = [tuple(float(v) for v in line.rstrip().split('\t'))
+                 for line in fid]
+
+###############################################################################
+# Compare detectors
+# -----------------
+#
+# For each detector, find the faces in every frame in batches, as
+# :func:`ephys_anonymizer.video_anonymize` does. A miss is counted when no
+# box is centered near the marked face location, the same way the face
+# is chosen in :func:`ephys_anonymizer.video_anonymize`, and any other box
+# is counted as a false positive.
+
+detectors = dict(haar=HaarDetector(), dnn=DNNDetector())
+for fname in ('test_vid.mp4', 'test_vid.avi'):
+    cap = cv2.VideoCapture(os.path.join(data_path, fname))
+    frames = list()
+    ret, frame = cap.read()
+    while ret:
+        frames.append(frame)
+        ret, frame = cap.read()
+    cap.release()
+    for name, detector in detectors.items():
+        start = time.time()
+        detections = list()
+        for i in range(0, len(frames), 8):
+            detections += detector.detect_batch(frames[i: i + 8])
+        fps = len(frames) / (time.time() - start)
+        n_missed = n_false = 0
+        for (boxes, scores), (fx, fy) in zip(detections, face_data):
+            n_found = sum(abs(x + w / 2 - fx) / fx +
+                          abs(y + h / 2 - fy) / fy < 0.1
+                          for x, y, w, h in boxes)
+            n_missed += n_found == 0
+            n_false += len(boxes) - n_found
+        print(f'{fname} {name}: {fps:.1f} frames per second, '
+              f'miss rate {n_missed / len(frames):.2f}, '
+              f'{n_false / len(frames):.1f} false positives per frame')
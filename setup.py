@@ -56,9 +56,13 @@ if __name__ == "__main__":
           ],
           platforms='any',
           packages=find_packages(),
+          package_data={'ephys_anonymizer': ['data/*.onnx',
+                                             'data/*.txt']},
           entry_points={'console_scripts': [
               'video_anonymize = '
               'ephys_anonymizer.commands.run:video_anonymize',
+              'video_verify = '
+              'ephys_anonymizer.commands.run:video_verify',
               'raw_anonymize = '
               'ephys_anonymizer.commands.run:raw_anonymize'
           ]},